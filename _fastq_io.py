@@ -0,0 +1,59 @@
+"""
+Shared FASTA/Q reading for the analysis scripts. Records are read as bytes,
+avoiding a utf-8 decode of every line; decode only where text is needed.
+"""
+try:
+    # ISA-L decompression is a drop-in, several times faster replacement
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+
+def open_fastq(path):
+    """Open a plain or gzipped FASTA/Q file in binary mode"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def readfq_bytes(fp, header=False):  # this is a generator function
+    """Read FASTA/Q records from binary file handle
+    https://github.com/lh3/readfq/blob/091bc699beee3013491268890cc3a7cbf995435b/readfq.py
+    Edited to work on bytes. If header is True, the full header line is yielded
+    in place of the read name.
+    """
+    last = None  # this is a buffer keeping the last unprocessed line
+    while True:  # mimic closure; is it a bad idea?
+        if not last:  # the first record or a record following a fastq
+            for l in fp:  # search for the start of the next record
+                if l[0] in b">@":  # fasta/q header line
+                    last = l[:-1]  # save this line
+                    break
+        if not last:
+            break
+        if header:
+            name, seqs, last = last[1:], [], None
+        else:
+            name, seqs, last = last[1:].partition(b" ")[0], [], None
+        for l in fp:  # read the sequence
+            if l[0] in b"@+>":
+                last = l[:-1]
+                break
+            seqs.append(l[:-1])
+        if not last or last[:1] != b"+":  # this is a fasta record
+            yield name, b"".join(seqs), None  # yield a fasta record
+            if not last:
+                break
+        else:  # this is a fastq record
+            seq, leng, seqs = b"".join(seqs), 0, []
+            for l in fp:  # read the quality
+                seqs.append(l[:-1])
+                leng += len(l) - 1
+                if leng >= len(seq):  # have read enough quality
+                    last = None
+                    yield name, seq, b"".join(seqs)
+                    # yield a fastq record
+                    break
+            if last:  # reach EOF before reading enough quality
+                yield name, seq, None  # yield a fasta record instead
+                break
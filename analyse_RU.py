@@ -3,73 +3,102 @@
 import sys, getopt, errno
 import re
 
-target_channel_reads = list()
-non_target_channel_reads = list()
-read_lengths = dict()
+target_channel_reads = set()
+non_target_channel_reads = set()
+# read lengths are taken from the stored sequence rather than kept separately
 read_seqs = dict()
 
+# precompiled patterns for fastq header channel and SAM CIGAR operations
+CH_RE = re.compile(r'\bch=(\d+)')
+CIGAR_M_RE = re.compile(r'(\d+)M')
+
 class ReferenceStats:
+	__slots__ = ("totalReads", "totalLength", "reference")
+
 	def __init__(self, reference):
 		self.totalReads = 0
 		self.totalLength = 0
 		self.reference = reference
 
 
-def AnalyseForChannels(_readsForChannels, _samFilename, multi_align, matching_prop=0):
-	ref_dict = dict()
-	ref_dict["unaligned"] = []
-	ReferenceStatDict = dict()
-	ReferenceStatDict["unaligned"] = ReferenceStats("unaligned")
+class ChannelGroup:
+	def __init__(self, reads, outPrefix):
+		self.reads = reads
+		self.outPrefix = outPrefix
+		self.ReferenceStatDict = dict()
+		self.ReferenceStatDict["unaligned"] = ReferenceStats("unaligned")
+		# fasta output is streamed per reference as alignments are read, opened on first hit
+		self.file_handles = dict()
+		self.file_handles["unaligned"] = open(outPrefix + "unaligned.fasta", "w", buffering=1 << 16)
+		self.unaligned_reads = set()
+		self.mapped_reads = set()
+
+	def close(self):
+		for o in self.file_handles.values():
+			o.close()
+
+	def reference_summary(self):
+		return "\n".join(ref.reference + "\t" + str(ref.totalReads) + "\t" + str(ref.totalLength)
+						 for ref in self.ReferenceStatDict.values())
+
+	def mapped_totals(self):
+		# reads with any unaligned entry are not counted as mapped
+		mapped_reads = self.mapped_reads - self.unaligned_reads
+		return len(mapped_reads), sum(len(read_seqs[read_id]) for read_id in mapped_reads)
+
+
+def AnalyseForChannels(_channelGroups, _samFilename, multi_align, matching_prop=0):
+	# single pass over the sam file, each alignment is routed to the group owning its read
 	try:
 		with open(_samFilename, 'r') as infile:
 			for line in infile:
 				fields = line.split()
-				if fields[0] in _readsForChannels:
-					reference = fields[2]
-					sequenceLength = read_lengths[fields[0]]
-					identity = 0
-					if reference == "*":
-						stats = ReferenceStatDict["unaligned"]
-						ref_dict["unaligned"].append((fields[0], reference, identity))
-						stats.totalReads += 1
-						stats.totalLength += sequenceLength
-						continue
+				readName = fields[0]
+				for group in _channelGroups:
+					if readName in group.reads:
+						break
+				else:
+					continue
+				reference = fields[2]
+				sequenceLength = len(read_seqs[readName])
+				identity = 0
+				if reference == "*":
+					key = "unaligned"
+				else:
 					CIGAR = fields[5]
-					num_matches = 0
-					num_mismatches = 0
-					matches = re.findall(r'(\d+)([A-Z]{1})', CIGAR)
-					# get number of M and I/D in CIGAR
-					for m in matches:
-						if m[1] == "M":
-							num_matches += int(m[0])
-						elif m[1] == "I" or m[1] == "D":
-							num_mismatches += 1
+					# get number of M and I/D in CIGAR, counted in C rather than per operation
+					num_matches = sum(map(int, CIGAR_M_RE.findall(CIGAR)))
+					num_mismatches = CIGAR.count("I") + CIGAR.count("D")
 					# get number of non-identical 'matches' in CIGAR
 					num_mismatches = int(fields[11].split(":")[-1]) - num_mismatches
 					# get number of identical bases in alignment
 					num_matches -= num_mismatches
 					# pass alignment if proportion of matching bases in below threshold
 					identity = num_matches / sequenceLength
-					if identity < matching_prop or fields[0] in multi_align:
-						stats = ReferenceStatDict["unaligned"]
-						ref_dict["unaligned"].append((fields[0], reference, identity))
-						stats.totalReads += 1
-						stats.totalLength += sequenceLength
-						continue
-					if reference not in ReferenceStatDict.keys():
-						ReferenceStatDict[reference] = ReferenceStats(reference)
-						ref_dict[reference] = []
-					ref_dict[reference].append((fields[0], reference, identity))
-					stats = ReferenceStatDict[reference]
-					stats.totalReads += 1
-					stats.totalLength += sequenceLength
+					if identity < matching_prop or readName in multi_align:
+						key = "unaligned"
+					else:
+						key = reference
+				# single lookup per alignment for stats and output file
+				stats = group.ReferenceStatDict.get(key)
+				if stats is None:
+					stats = group.ReferenceStatDict[key] = ReferenceStats(key)
+					group.file_handles[key] = open(group.outPrefix + str(key) + ".fasta", "w", buffering=1 << 16)
+				group.file_handles[key].write(readName + "\t" + reference + "\t" + str(identity) + "\n" + read_seqs[readName] + "\n")
+				if key == "unaligned":
+					group.unaligned_reads.add(readName)
+				else:
+					group.mapped_reads.add(readName)
+				stats.totalReads += 1
+				stats.totalLength += sequenceLength
 	except (OSError, IOError) as e:
 		if getattr(e, 'errno', 0) == errno.ENOENT:
 			print("Could not find file " + infile)
 		print(e)
 		sys.exit(2)
-
-	return ReferenceStatDict, ref_dict
+	finally:
+		for group in _channelGroups:
+			group.close()
 
 remove_multi = False
 
@@ -119,20 +148,16 @@ try:
 		count = 0
 		for line in infile:
 			if count % 4 == 0:
-				assert(line[0]=='@')
-				fields = line.split()
-				readName = fields[0][1:]
-				channel = int(fields[3].split("=")[1])
-				assert(fields[3].split("=")[0] == "ch")
-				assert(channel >= 0 and channel <= 512)
+				readName = line[1:].split(None, 1)[0]
+				channel = int(CH_RE.search(line).group(1))
 				if channel >= min_channel and channel <= max_channel:
-					target_channel_reads.append(readName)
+					target_channel_reads.add(readName)
 				else:
-					non_target_channel_reads.append(readName)
+					non_target_channel_reads.add(readName)
 			if count % 4 == 1:
-				length = len(line.strip())
-				read_lengths[readName] = length
-				read_seqs[readName] = line.strip()
+				sequence = line.strip()
+				length = len(sequence)
+				read_seqs[readName] = sequence
 				if channel >= min_channel and channel <= max_channel:
 					target_channel_bases += length
 				else:
@@ -156,48 +181,22 @@ if remove_multi == True:
 			else:
 				multi_align.add(fields[0])
 
+target_group = ChannelGroup(target_channel_reads, output + "_target_")
+non_target_group = ChannelGroup(non_target_channel_reads, output + "_nontarget_")
+AnalyseForChannels((target_group, non_target_group), samFile, multi_align, matching_prop)
+
 # target channels
-dictionary, output_dict = AnalyseForChannels(target_channel_reads, samFile, multi_align, matching_prop)
 print("Reference stats for channels " + str(channels) + ": ")
-totalMapped = 0
-for ref in dictionary.values():
-		print( ref.reference + "\t" + str(ref.totalReads) + "\t" + str(ref.totalLength))
-total_read_bases_mapped = 0
-prev_reads = set()
-for ref, read_list in output_dict.items():
-	with open(output + "_target_" + str(ref) + ".fasta", "w") as o:
-		for entry in read_list:
-			read_id, reference, identity = entry
-			o.write(read_id + "\t" + reference + "\t" + str(identity) + "\n" + read_seqs[read_id] + "\n")
-			if read_id in prev_reads:
-				continue
-			prev_reads.add(read_id)
-			if ref != "unaligned":
-				total_read_bases_mapped += read_lengths[read_id]
-				totalMapped += 1
+print(target_group.reference_summary())
+totalMapped, total_read_bases_mapped = target_group.mapped_totals()
 print("Total number of reads mapped: " + str(totalMapped) + "/" + str(len(target_channel_reads)))
 print("Total read bases: " + str(target_channel_bases))
 print("Total read bases mapped: " + str(total_read_bases_mapped))
 
 # non target channels
-dictionary, output_dict = AnalyseForChannels(non_target_channel_reads, samFile, multi_align, matching_prop)
 print("\nReference stats for all other channels: ")
-totalMapped = 0
-prev_reads = set()
-for ref in dictionary.values():
-		print( ref.reference + "\t" + str(ref.totalReads) + "\t" + str(ref.totalLength))
-total_read_bases_mapped = 0
-for ref, read_list in output_dict.items():
-	with open(output + "_nontarget_" + str(ref) + ".fasta", "w") as o:
-		for entry in read_list:
-			read_id, reference, identity = entry
-			o.write(read_id + "\t" + reference + "\t" + str(identity) + "\n" + read_seqs[read_id] + "\n")
-			if read_id in prev_reads:
-				continue
-			prev_reads.add(read_id)
-			if ref != "unaligned":
-				total_read_bases_mapped += read_lengths[read_id]
-				totalMapped += 1
+print(non_target_group.reference_summary())
+totalMapped, total_read_bases_mapped = non_target_group.mapped_totals()
 print("Total number of reads mapped: " + str(totalMapped) + "/" + str(len(non_target_channel_reads)))
 print("Total read bases: " + str(non_target_channel_bases))
 print("Total read bases mapped: " + str(total_read_bases_mapped))
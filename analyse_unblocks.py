@@ -1,14 +1,21 @@
 """
 Adapted from summarise_fq.py (https://github.com/LooseLab/readfish/blob/master/ru/summarise_fq.py)
 """
-import gzip
 from pathlib import Path
+import csv
+import re
 from statistics import mean, median, stdev
-from collections import defaultdict
 import sys
 import os, glob
+import threading
+import queue
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import mappy as mp
 
+from _fastq_io import open_fastq, readfq_bytes
+
 import argparse
 
 def get_options():
@@ -34,47 +41,19 @@ def get_options():
                     help='Output file.')
     IO.add_argument('--ref',
                     default=None,
-                    help='Specify minimap2 index. No alignment done if not specified. ')
+                    help='Specify minimap2 index (.mmi), built with '
+                         '"minimap2 -x map-ont -d ref.mmi ref.fa". No alignment done if not specified. ')
+    IO.add_argument('--threads',
+                    type=int,
+                    default=1,
+                    help='Number of read files to process in parallel. Default = 1')
+    IO.add_argument('--map-threads',
+                    type=int,
+                    default=None,
+                    help='Number of alignment threads per read file. '
+                         'Default = available CPUs divided by --threads')
     return parser.parse_args()
 
-def readfq(fp):  # this is a generator function
-    """Read FASTA/Q records from file handle
-    https://github.com/lh3/readfq/blob/091bc699beee3013491268890cc3a7cbf995435b/readfq.py
-    """
-    last = None  # this is a buffer keeping the last unprocessed line
-    while True:  # mimic closure; is it a bad idea?
-        if not last:  # the first record or a record following a fastq
-            for l in fp:  # search for the start of the next record
-                if l[0] in ">@":  # fasta/q header line
-                    last = l[:-1]  # save this line
-                    break
-        if not last:
-            break
-        name, seqs, last = last[1:].partition(" ")[0], [], None
-        for l in fp:  # read the sequence
-            if l[0] in "@+>":
-                last = l[:-1]
-                break
-            seqs.append(l[:-1])
-        if not last or last[0] != "+":  # this is a fasta record
-            yield name, "".join(seqs), None  # yield a fasta record
-            if not last:
-                break
-        else:  # this is a fastq record
-            seq, leng, seqs = "".join(seqs), 0, []
-            for l in fp:  # read the quality
-                seqs.append(l[:-1])
-                leng += len(l) - 1
-                if leng >= len(seq):  # have read enough quality
-                    last = None
-                    yield name, seq, "".join(seqs)
-                    # yield a fastq record
-                    break
-            if last:  # reach EOF before reading enough quality
-                yield name, seq, None  # yield a fasta record instead
-                break
-
-
 def get_fq(directory):
     types = ([".fastq"], [".fastq", ".gz"], [".fq"], [".fq", ".gz"])
     files = (
@@ -83,6 +62,140 @@ def get_fq(directory):
     yield from files
 
 
+# filter and barcode fields of read file names, e.g. <flowcell>_pass_barcode01_<run>_0.fastq.gz
+FNAME_RE = re.compile(r'^[^_]*_([^_.]*)(?:_([^_.]*))?')
+
+# per-process cache of aligners, keyed by reference path
+_aligners = {}
+
+# read id sets shared with worker processes, set by init_worker
+_unblock_set = set()
+_mux_set = set()
+
+
+def init_worker(unblock_set, mux_set):
+    global _unblock_set, _mux_set
+    _unblock_set = unblock_set
+    _mux_set = mux_set
+
+
+def get_aligner(reference):
+    # load aligner lazily within each worker, avoids pickling the index.
+    # Workers share the same prebuilt .mmi path, so the page cache serves it once
+    if reference not in _aligners:
+        aligner = mp.Aligner(reference, preset="map-ont", n_threads=1)
+        if not aligner:
+            raise Exception("ERROR: failed to load index {}".format(reference))
+        _aligners[reference] = aligner
+    return _aligners[reference]
+
+
+# per-thread minimap2 buffers
+_thread_local = threading.local()
+
+# number of reads aligned per pool task
+BATCH_SIZE = 256
+
+# parsed batches buffered ahead of alignment
+QUEUE_BATCHES = 8
+
+
+def align_one(mapper, seq, buf):
+    # Map seq, only use first mapping (a bit janky)
+    hit = next(mapper.map(seq, buf=buf), None)
+    if hit is None:
+        return "None"
+    return hit.ctg
+
+
+def align_batch(mapper, batch):
+    # mappy releases the GIL while mapping, each thread needs its own buffer
+    buf = getattr(_thread_local, "buf", None)
+    if buf is None:
+        buf = _thread_local.buf = mp.ThreadBuffer()
+    return [align_one(mapper, seq, buf) for _, seq, _ in batch]
+
+
+def batched(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+def read_batches(f, q, errors):
+    # producer, decompression and parsing overlap alignment as both release the GIL
+    try:
+        with open_fastq(f) as fh:
+            for batch in batched(readfq_bytes(fh), BATCH_SIZE):
+                q.put(batch)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        q.put(None)
+
+
+def process_file(f, reference, map_threads):
+    # reads keyed by ((filter, barcode), ref)
+    target_reads_dict = {}
+    unblocks_reads_dict = {}
+
+    if reference is not None:
+        mapper = get_aligner(reference)
+
+    # get filter and barcode from filename, once per file
+    m = FNAME_RE.match(os.path.basename(f))
+    if m is None:
+        file_id = ("NA", "NA")
+    elif m.group(2) and "barcode" in m.group(2):
+        file_id = (m.group(1), m.group(2))
+    else:
+        file_id = (m.group(1), "NA")
+
+    def record(batch, refs):
+        refs = ["None"] * len(batch) if refs is None else refs.result()
+        for (name, seq, _), ref in zip(batch, refs):
+            # check if in mux-period
+            mux = 0
+            if name in _mux_set:
+                mux = 1
+
+            reads_dict = unblocks_reads_dict if name in _unblock_set else target_reads_dict
+            reads_dict.setdefault((file_id, ref), []).append((name, len(seq), mux))
+
+    # parse on a producer thread through a bounded queue, align batches on the pool
+    # and record them in read order, keeping only a few batches in memory
+    q = queue.Queue(maxsize=QUEUE_BATCHES)
+    errors = []
+    producer = threading.Thread(target=read_batches, args=(f, q, errors), daemon=True)
+    producer.start()
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=map_threads) as pool:
+        for batch in iter(q.get, None):
+            refs = None
+            if reference is not None:
+                refs = pool.submit(align_batch, mapper, batch)
+            pending.append((batch, refs))
+            if len(pending) > 2 * map_threads:
+                record(*pending.popleft())
+        while pending:
+            record(*pending.popleft())
+
+    producer.join()
+    if errors:
+        raise errors[0]
+
+    return target_reads_dict, unblocks_reads_dict
+
+
+def merge(partial, reads_dict):
+    for key, length_list in partial.items():
+        reads_dict.setdefault(key, []).extend(length_list)
+
+
 def main():
     options = get_options()
     reference = options.ref
@@ -92,6 +205,13 @@ def main():
     summary = options.summary
     mux_period = options.mux_period
 
+    # require a prebuilt index, so it is not rebuilt from fasta by every worker
+    if reference is not None and not reference.endswith(".mmi"):
+        print("Reference must be a minimap2 index (.mmi). Build one with:\n"
+              "minimap2 -x map-ont -d {}.mmi {}".format(os.path.splitext(reference)[0], reference),
+              file=sys.stderr)
+        sys.exit(2)
+
     if unblocks is None:
         unblocks = os.path.join(indir, "unblocked_read_ids.txt")
 
@@ -99,81 +219,56 @@ def main():
         sum_list = glob.glob(os.path.join(indir, "sequencing_summary_*.txt"))
         summary = sum_list[0]
 
-    # create unblocks set
+    # create unblocks set, read ids are kept as bytes to match readfq_bytes
     unblock_set = set()
-    with open(unblocks, "r") as f:
+    with open(unblocks, "rb") as f:
         for line in f:
             unblock_set.add(line.strip())
     print("Total unblocks: {}".format(len(unblock_set)))
 
     # create mux-period set
     mux_set = set()
-    with open(summary, "r") as f:
+    with open(summary, "rb") as f:
         # ignore header
         next(f)
         for line in f:
-            entry = line.strip().split("\t")
+            entry = line.strip().split(b"\t")
             read_id = entry[4]
             start_time = float(entry[9])
             if start_time < mux_period:
                 mux_set.add(read_id)
 
     if reference is not None:
-        mapper = mp.Aligner(reference, preset="map-ont")
+        # start reading the index into the page cache before workers load it
+        if hasattr(os, "posix_fadvise"):
+            with open(reference, "rb") as f:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
 
         print("Using reference: {}".format(reference), file=sys.stderr)
 
-    target_reads_dict = defaultdict(lambda: defaultdict(list))
-    unblocks_reads_dict = defaultdict(lambda: defaultdict(list))
-
-    for f in get_fq(indir):
-        if f.endswith(".gz"):
-            fopen = gzip.open
-        else:
-            fopen = open
-
-        # get filename and extension
-        base = os.path.splitext(os.path.basename(f))[0].split("_")
-        #print(base)
-        if "barcode" in base[2]:
-            file_id = "_".join([base[1], base[2]])
-        else:
-            file_id = "_".join([base[1], "NA"])
-
-        with fopen(f, "rt") as fh:
-            for name, seq, _ in readfq(fh):
-                ref = "None"
-                if reference is not None:
-                    # Map seq, only use first mapping (a bit janky)
-                    for r in mapper.map(seq):
-                        ref = r.ctg
-                        break
-
-                # check if in mux-period
-                mux = 0
-                if name in mux_set:
-                    mux = 1
-
-                if name in unblock_set:
-                    unblocks_reads_dict[file_id][ref].append((name, len(seq), mux))
-                else:
-                    target_reads_dict[file_id][ref].append((name, len(seq), mux))
-                    #print(name)
-
-    with open(out, "w") as o:
-        o.write("Type\tFilter\tBarcode\tRef\tLength\tName\tMux\n")
-        for file_id, entry in target_reads_dict.items():
-            type = file_id.split("_")
-            for ref, length_list in entry.items():
-                for len_entry in length_list:
-                    o.write("Target\t" + type[0] + "\t" + type[1] + "\t" + ref + "\t" + str(len_entry[1])
-                            + "\t" + len_entry[0] + "\t" + str(len_entry[2]) + "\n")
-        for file_id, entry in unblocks_reads_dict.items():
-            type = file_id.split("_")
-            for ref, length_list in entry.items():
-                for len_entry in length_list:
-                    o.write("Non-target\t" + type[0] + "\t" + type[1] + "\t" + ref + "\t" + str(len_entry[1])
-                            + "\t" + len_entry[0] + "\t" + str(len_entry[2]) + "\n")
+    target_reads_dict = {}
+    unblocks_reads_dict = {}
+
+    map_threads = options.map_threads
+    if map_threads is None:
+        map_threads = max(1, (os.cpu_count() or 1) // options.threads)
+
+    files = list(get_fq(indir))
+    with ProcessPoolExecutor(max_workers=options.threads, initializer=init_worker,
+                             initargs=(unblock_set, mux_set)) as ex:
+        for target_partial, unblocks_partial in ex.map(process_file, files, [reference] * len(files),
+                                                          [map_threads] * len(files)):
+            merge(target_partial, target_reads_dict)
+            merge(unblocks_partial, unblocks_reads_dict)
+
+    # rows are built per (file, ref) block and written by csv's C writer
+    with open(out, "w", buffering=1 << 20, newline="") as o:
+        writer = csv.writer(o, delimiter="\t", lineterminator="\n", quoting=csv.QUOTE_NONE, quotechar=None)
+        writer.writerow(("Type", "Filter", "Barcode", "Ref", "Length", "Name", "Mux"))
+        for read_type, reads_dict in (("Target", target_reads_dict), ("Non-target", unblocks_reads_dict)):
+            for ((read_filter, barcode), ref), length_list in reads_dict.items():
+                writer.writerows([(read_type, read_filter, barcode, ref, length, name.decode(), mux)
+                                  for name, length, mux in length_list])
 
 
 if __name__ == "__main__":
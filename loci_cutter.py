@@ -38,22 +38,25 @@ def get_best_map(index, fasta, cutoff):
     a = mp.Aligner(index, preset="asm10")
 
     best_hit = (None, None, 0, 0, 0)
+    best_len = 0
 
     fasta_sequences = SeqIO.parse(open(fasta), 'fasta')
     for fasta in fasta_sequences:
         id, sequence = fasta.id, str(fasta.seq)
 
+        # set cutoff for minimum alignment length, once per query
+        cutoff_len = cutoff * len(sequence)
+
         for hit in a.map(sequence):
             if not hit.is_primary:
                 continue
             query_hit = hit.blen
 
-            # set cutoff for minimum alignment length
-            if query_hit < cutoff * len(sequence):
+            if query_hit < cutoff_len or query_hit <= best_len:
                 continue
 
-            if query_hit > best_hit[-1]:
-                best_hit = (id, hit.ctg, hit.r_st, hit.r_en, query_hit)
+            best_len = query_hit
+            best_hit = (id, hit.ctg, hit.r_st, hit.r_en, query_hit)
 
     return best_hit
 
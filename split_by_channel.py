@@ -1,8 +1,11 @@
-from Bio import SeqIO
-from Bio.SeqRecord import SeqRecord
 import argparse
+import re
 import statistics
 
+from _fastq_io import open_fastq, readfq_bytes
+
+CH_RE = re.compile(rb'\bch=(\d+)')
+
 def get_options():
     description = "Splits fastq files by channel"
     parser = argparse.ArgumentParser(description=description,
@@ -19,23 +22,16 @@ def get_options():
     return parser.parse_args()
 
 def split_by_channel(input_file, out_prefix, start_channel, end_channel):
-    target_channels = []
-    nontarget_channels = []
-
-    file_entries = SeqIO.parse(open(input_file), 'fastq')
-    for entry in file_entries:
-        id, sequence, description = entry.id, entry.seq, entry.description
-
-        channel_index = description.find("ch=")
-        channel = int(description[channel_index:].split("=", 1)[-1].split(" ")[0])
-
-        if channel >= start_channel and channel <= end_channel:
-            target_channels.append(entry)
-        else:
-            nontarget_channels.append(entry)
-
-    SeqIO.write(target_channels, out_prefix + "_target.fastq", "fastq")
-    SeqIO.write(nontarget_channels, out_prefix + "_nontarget.fastq", "fastq")
+    with open_fastq(input_file) as f, open(out_prefix + "_target.fastq", "wb") as o_target, \
+            open(out_prefix + "_nontarget.fastq", "wb") as o_nontarget:
+        for description, sequence, quality in readfq_bytes(f, header=True):
+            channel = int(CH_RE.search(description).group(1))
+
+            if channel >= start_channel and channel <= end_channel:
+                o = o_target
+            else:
+                o = o_nontarget
+            o.write(b"@" + description + b"\n" + sequence + b"\n+\n" + quality + b"\n")
 
 def main():
     options = get_options()